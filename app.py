@@ -1,12 +1,17 @@
 import streamlit as st
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from utils import (
     generate_sql,
+    generate_ai_summary,
     execute_query,
     detect_metric_question,
     extract_query_parameters,
-    get_all_data,
     calculate_derived_metrics,
+    get_metrics_table,
+    load_geojson_data,
+    SQL_FENCE_PATTERN,
     MODEL_CONFIG  # MODEL_CONFIGをインポート
 )
 from view import (
@@ -60,6 +65,8 @@ def initialize_session_state():
         st.session_state.is_metric_question = False
     if "query_params" not in st.session_state:
         st.session_state.query_params = {}
+    if "ai_summary" not in st.session_state:
+        st.session_state.ai_summary = None
 
 # --- メインの実行ロジック ---
 def main():
@@ -79,37 +86,53 @@ def main():
                 st.warning("⚠️ 質問を入力してください。")
                 st.stop()
 
-            with st.spinner(f"🤖 AI ({st.session_state.model_name}) がSQLを生成中..."):
-                generated_sql = generate_sql(user_question, st.session_state.model_name)
+            # SQL生成（ネットワーク待ち）の間に、DB接続・派生指標の事前計算と地図用GeoJSONの読み込みを並行して済ませておく
+            # 生成途中のSQLは逐次表示し、完了したら結果表示に任せて消す
+            sql_placeholder = st.empty()
+            with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+                executor.submit(get_metrics_table)
+                executor.submit(load_geojson_data)
+                with st.spinner(f"🤖 AI ({st.session_state.model_name}) がSQLを生成中..."):
+                    generated_sql = generate_sql(
+                        user_question,
+                        st.session_state.model_name,
+                        on_chunk=lambda text: sql_placeholder.code(SQL_FENCE_PATTERN.sub("", text).strip(), language="sql")
+                    )
+            sql_placeholder.empty()
             st.session_state.generated_sql = generated_sql
 
+            st.session_state.ai_summary = None
             if generated_sql:
                 with st.spinner("💾 データベースでクエリを実行中..."):
                     result_df = execute_query(generated_sql)
                 st.session_state.result_df = result_df
                 st.session_state.is_metric_question = detect_metric_question(user_question)
 
-                if st.session_state.is_metric_question and result_df is not None:
-                    with st.spinner("📊 派生指標を計算中..."):
-                        query_params = extract_query_parameters(generated_sql, user_question)
-                        population_df = get_all_data('population')
-                        business_df = get_all_data('business_stats')
-                        if population_df is not None and business_df is not None:
-                            metrics_df = calculate_derived_metrics(
-                                business_df, population_df,
+                # AIによる分析コメント（ネットワーク待ち）は、派生指標の計算と並行して生成する
+                with ThreadPoolExecutor(max_workers=1, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+                    summary_future = None
+                    if result_df is not None and not result_df.empty:
+                        summary_future = executor.submit(generate_ai_summary, result_df, user_question, st.session_state.model_name)
+
+                    if st.session_state.is_metric_question and result_df is not None:
+                        with st.spinner("📊 派生指標を計算中..."):
+                            query_params = extract_query_parameters(generated_sql, user_question)
+                            st.session_state.metrics_df = calculate_derived_metrics(
                                 year=query_params.get('year'),
                                 industry=query_params.get('industry'),
-                                town=query_params.get('town')
+                                town=query_params.get('town'),
+                                result_df=result_df
                             )
-                            st.session_state.metrics_df = metrics_df
                             st.session_state.query_params = query_params
-                        else:
-                            st.session_state.metrics_df = None
-                else:
-                    st.session_state.metrics_df = None
-                    st.session_state.query_params = {}
+                    else:
+                        st.session_state.metrics_df = None
+                        st.session_state.query_params = {}
+
+                    if summary_future is not None:
+                        with st.spinner(f"🤖 AI ({st.session_state.model_name}) が結果を分析中..."):
+                            st.session_state.ai_summary = summary_future.result()
 
-        render_results(st.session_state.result_df, st.session_state.generated_sql, st.session_state.user_question, st.session_state.model_name)
+        render_results(st.session_state.result_df, st.session_state.generated_sql, st.session_state.ai_summary)
         
         if st.session_state.is_metric_question:
             render_metrics_and_insights(
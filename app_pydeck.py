@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import geopandas as gpd
 import pydeck as pdk
 from typing import Optional
@@ -9,15 +10,19 @@ import logging
 from utils import (
     generate_sql,
     execute_query,
-    get_all_data,
     calculate_derived_metrics,
     generate_interpretation,
     generate_contextual_explanation,
     get_top_bottom_insights,
     extract_query_parameters,
     detect_metric_question,
-    load_geojson_data,
+    load_polygon_data,
     get_db_connection,
+    convert_df_to_csv,
+    METRIC_COLUMNS,
+    METRICS_DISPLAY_RENAME_MAP,
+    METRICS_COLUMN_CONFIG,
+    SQL_FENCE_PATTERN,
     MODEL_CONFIG  # MODEL_CONFIGをインポート
 )
 
@@ -103,12 +108,22 @@ with col3:
         st.session_state.user_question = "2024年の町名毎の事業所密度を教えて"
 
 # 質問入力（セッション状態と直接バインド）
-user_question = st.text_input("🔍 分析したい内容を質問してください:", key="user_question")
+# 入力中に再実行されないよう、質問入力と実行ボタンをフォームにまとめる
+with st.form("query_form"):
+    user_question = st.text_input("🔍 分析したい内容を質問してください:", key="user_question")
+    submitted = st.form_submit_button("🚀 分析を実行", type="primary")
 
-if st.button("🚀 分析を実行", type="primary"):
+if submitted:
     if user_question:
+        # 生成途中のSQLは逐次表示し、完了したら結果表示に任せて消す
+        sql_placeholder = st.empty()
         with st.spinner(f"🤖 AI ({MODEL_CONFIG[st.session_state.model_name]['label']}) がSQLを生成中..."):
-            generated_sql = generate_sql(user_question, st.session_state.model_name)
+            generated_sql = generate_sql(
+                user_question,
+                st.session_state.model_name,
+                on_chunk=lambda text: sql_placeholder.code(SQL_FENCE_PATTERN.sub("", text).strip(), language="sql")
+            )
+        sql_placeholder.empty()
 
         if generated_sql:
             st.session_state.generated_sql = generated_sql
@@ -121,28 +136,66 @@ if st.button("🚀 分析を実行", type="primary"):
             if st.session_state.is_metric_question and result_df is not None and not result_df.empty:
                 with st.spinner("📊 派生指標を計算中..."):
                     query_params = extract_query_parameters(generated_sql, user_question)
-                    population_df = get_all_data('population')
-                    business_df = get_all_data('business_stats')
-
-                    if population_df is not None and business_df is not None:
-                        metrics_df = calculate_derived_metrics(
-                            business_df, 
-                            population_df,
-                            year=query_params['year'],
-                            industry=query_params['industry'],
-                            town=query_params['town']
-                        )
-                        st.session_state.metrics_df = metrics_df
-                        st.session_state.query_params = query_params
-                    else:
-                        st.session_state.metrics_df = None
-                        st.session_state.query_params = {}
+                    st.session_state.metrics_df = calculate_derived_metrics(
+                        year=query_params['year'],
+                        industry=query_params['industry'],
+                        town=query_params['town'],
+                        result_df=result_df
+                    )
+                    st.session_state.query_params = query_params
             else:
                 st.session_state.metrics_df = None
                 st.session_state.query_params = {}
     else:
         st.warning("⚠️ 質問を入力してください。")
 
+# --- 地図表示（指標を切り替えたときは、ページ全体ではなく地図部分だけを再実行する） ---
+@st.fragment
+def render_pydeck_map(result_df: pd.DataFrame, numeric_cols: list[str]):
+    """ 分析結果の指標を選択してpydeckの地図に表示する """
+    st.subheader("🗺️ 地図で結果を確認")
+    
+    metric_to_map = st.selectbox("地図に表示する指標を選択してください:", options=numeric_cols, index=0)
+
+    with st.spinner("🗺️ 地図データを生成中..."):
+        polygon_df = load_polygon_data()
+        if polygon_df is not None:
+            # レイヤーに渡すのは町名と表示する指標だけにして、ブラウザへ送るデータを小さくする
+            map_df = polygon_df.merge(result_df[['town_name', metric_to_map]], on='town_name', how='inner')
+
+            if not map_df.empty:
+                max_val = map_df[metric_to_map].max()
+                min_val = map_df[metric_to_map].min()
+                
+                if max_val > min_val:
+                    map_df['normalized'] = (map_df[metric_to_map] - min_val) / (max_val - min_val)
+                else:
+                    map_df['normalized'] = 0.5
+                
+                # 行ごとに関数を呼ばず、RGBAをまとめて計算する（赤→緑、欠損値は中間色）
+                normalized = np.nan_to_num(map_df['normalized'].to_numpy(dtype=np.float64), nan=0.5)
+                rgba = np.empty((len(normalized), 4), dtype=np.uint8)
+                rgba[:, 0] = 255 * (1 - normalized)
+                rgba[:, 1] = 255 * normalized
+                rgba[:, 2] = 0
+                rgba[:, 3] = 180
+                map_df['fill_color'] = rgba.tolist()
+                
+                st.pydeck_chart(pdk.Deck(
+                    map_style=None,
+                    initial_view_state=pdk.ViewState(latitude=35.655, longitude=139.33, zoom=11, pitch=0),
+                    layers=[
+                        pdk.Layer('PolygonLayer', data=map_df[['town_name', 'coordinates', 'fill_color', metric_to_map]], get_polygon='coordinates', filled=True, stroked=True, get_fill_color='fill_color', get_line_color=[80, 80, 80], line_width_min_pixels=1, pickable=True, auto_highlight=True)
+                    ],
+                    tooltip={"html": f"<b>町名:</b> {{town_name}}<br/><b>{metric_to_map}:</b> {{{metric_to_map}}}", "style": {"backgroundColor": "steelblue", "color": "white"}}
+                ))
+                
+                st.caption(f"🎨 色の凡例: 赤（低い値: {min_val:.2f}）→ 黄色（中間）→ 緑（高い値: {max_val:.2f}）")
+            else:
+                st.warning("⚠️ 地図データと結合できる町名が見つかりませんでした。")
+        else:
+            st.error("❌ 地図データの読み込みに失敗しました。")
+
 # --- 結果表示（セッション状態から復元） ---
 if st.session_state.generated_sql:
     with st.expander("📝 生成されたSQLクエリ", expanded=False):
@@ -177,99 +230,56 @@ if st.session_state.result_df is not None and not st.session_state.result_df.emp
             
             st.subheader("📊 経済指標の詳細分析")
 
+            # 各指標の平均はまとめて一度だけ計算する
+            means = metrics_df[METRIC_COLUMNS].mean()
+
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                avg_density = metrics_df['office_density'].mean()
-                st.metric("平均事業所密度", f"{avg_density:.4f}", help="事業所数 ÷ 世帯数\n\n値が高いほど、世帯数に対して事業所が多い（商業地域的）")
+                st.metric("平均事業所密度", f"{means['office_density']:.4f}", help="事業所数 ÷ 世帯数\n\n値が高いほど、世帯数に対して事業所が多い（商業地域的）")
             with col2:
-                avg_ratio = metrics_df['employee_ratio'].mean()
-                st.metric("平均従業者比率", f"{avg_ratio:.4f}", help="従業者数 ÷ 人口数\n\n値が高いほど、人口に対して働く人が多い（雇用が活発）")
+                st.metric("平均従業者比率", f"{means['employee_ratio']:.4f}", help="従業者数 ÷ 人口数\n\n値が高いほど、人口に対して働く人が多い（雇用が活発）")
             with col3:
-                avg_size = metrics_df['office_size'].mean()
-                st.metric("平均事業所規模", f"{avg_size:.1f}人", help="従業者数 ÷ 事業所数\n\n値が大きいほど、1事業所あたりの従業員が多い（大規模事業所）")
+                st.metric("平均事業所規模", f"{means['office_size']:.1f}人", help="従業者数 ÷ 事業所数\n\n値が大きいほど、1事業所あたりの従業員が多い（大規模事業所）")
             with col4:
-                avg_per_1000 = metrics_df['offices_per_1000_pop'].mean()
-                st.metric("人口1000人あたり事業所数", f"{avg_per_1000:.1f}", help="(事業所数 ÷ 人口) × 1000\n\n国際比較などで使われる標準指標")
+                st.metric("人口1000人あたり事業所数", f"{means['offices_per_1000_pop']:.1f}", help="(事業所数 ÷ 人口) × 1000\n\n国際比較などで使われる標準指標")
 
-            interpretation = generate_interpretation(metrics_df)
+            interpretation = generate_interpretation(means)
             
             insights = ""
-            if 'town_name' in metrics_df.columns and len(metrics_df['town_name'].unique()) > 1:
+            if 'town_name' in metrics_df.columns and metrics_df['town_name'].nunique() > 1:
                 insights += get_top_bottom_insights(metrics_df, 'office_density', '事業所密度', n=3)
             
             full_interpretation = f"💡 **データから読み取れること**\n\n{interpretation}{insights}"
             st.success(full_interpretation)
 
             with st.expander("📋 詳細な指標データを表示", expanded=False):
-                display_cols = ['year', 'town_name', 'num_offices', 'num_employees', 'num_households', 'num_population',
-                              'office_density', 'employee_ratio', 'office_size', 'offices_per_1000_pop']
-                available_cols = [col for col in display_cols if col in metrics_df.columns]
-                
-                col_rename = {'year': '年度', 'town_name': '町名', 'num_offices': '事業所数', 'num_employees': '従業者数', 'num_households': '世帯数', 'num_population': '人口数', 'office_density': '事業所密度', 'employee_ratio': '従業者比率', 'office_size': '事業所規模', 'offices_per_1000_pop': '人口千人あたり事業所数'}
+                available_cols = [col for col in METRICS_DISPLAY_RENAME_MAP if col in metrics_df.columns]
                 
-                display_df = metrics_df[available_cols].copy().rename(columns=col_rename)
+                display_df = metrics_df[available_cols].rename(columns=METRICS_DISPLAY_RENAME_MAP, copy=False)
                 
-                st.dataframe(display_df.round(4), use_container_width=True, hide_index=True)
+                st.dataframe(display_df, column_config=METRICS_COLUMN_CONFIG, use_container_width=True, hide_index=True)
                 
-                csv = display_df.to_csv(index=False).encode('utf-8-sig')
+                csv = convert_df_to_csv(display_df)
                 st.download_button("📥 CSVでダウンロード", csv, "hachioji_metrics.csv", "text/csv", key='download-csv')
 
+    # グラフと地図で共通して使うため、カラムの型判定は一度だけ行う
+    numeric_cols = result_df.select_dtypes(include=['number']).columns.tolist()
+    category_cols = result_df.select_dtypes(include=['object', 'string']).columns.tolist()
+
     if len(result_df.columns) >= 2:
         try:
-            numeric_cols = result_df.select_dtypes(include=['number']).columns.tolist()
-            category_cols = result_df.select_dtypes(include=['object']).columns.tolist()
-
             if category_cols and numeric_cols:
                 st.subheader("📈 データ可視化")
-                chart_df = result_df.set_index(category_cols[0])[numeric_cols[0]]
-                st.bar_chart(chart_df)
+                # インデックスを作り直さず、x/y のカラムを指定して描画する
+                st.bar_chart(result_df, x=category_cols[0], y=numeric_cols[0])
         except Exception as e:
             logger.warning(f"グラフ描画スキップ: {e}")
 
     if result_df is not None and not result_df.empty:
 
-        numeric_cols = result_df.select_dtypes(include=['number']).columns.tolist()
-        if 'town_name' in result_df.columns and len(numeric_cols) > 0:
-            st.subheader("🗺️ 地図で結果を確認")
-            
-            metric_to_map = st.selectbox("地図に表示する指標を選択してください:", options=numeric_cols, index=0)
-
-            with st.spinner("🗺️ 地図データを生成中..."):
-                gdf = load_geojson_data()
-                if gdf is not None:
-                    map_df = gdf.merge(result_df, on='town_name', how='inner')
-
-                    if not map_df.empty:
-                        max_val = map_df[metric_to_map].max()
-                        min_val = map_df[metric_to_map].min()
-                        
-                        if max_val > min_val:
-                            map_df['normalized'] = (map_df[metric_to_map] - min_val) / (max_val - min_val)
-                        else:
-                            map_df['normalized'] = 0.5
-                        
-                        def get_color(normalized_value):
-                            r = int(255 * (1 - normalized_value))
-                            g = int(255 * normalized_value)
-                            b = 0
-                            return [r, g, b, 180]
-                        
-                        map_df['fill_color'] = map_df['normalized'].apply(get_color)
-                        
-                        st.pydeck_chart(pdk.Deck(
-                            map_style=None,
-                            initial_view_state=pdk.ViewState(latitude=35.655, longitude=139.33, zoom=11, pitch=0),
-                            layers=[
-                                pdk.Layer('PolygonLayer', data=map_df, get_polygon='coordinates', filled=True, stroked=True, get_fill_color='fill_color', get_line_color=[80, 80, 80], line_width_min_pixels=1, pickable=True, auto_highlight=True)
-                            ],
-                            tooltip={"html": f"<b>町名:</b> {{town_name}}<br/><b>{metric_to_map}:</b> {{{metric_to_map}}}", "style": {"backgroundColor": "steelblue", "color": "white"}}
-                        ))
-                        
-                        st.caption(f"🎨 色の凡例: 赤（低い値: {min_val:.2f}）→ 黄色（中間）→ 緑（高い値: {max_val:.2f}）")
-                    else:
-                        st.warning("⚠️ 地図データと結合できる町名が見つかりませんでした。")
-                else:
-                    st.error("❌ 地図データの読み込みに失敗しました。")
+        # 町が1つしかない結果（単一町の推移など）は色分けの意味がないため、地図を表示しない
+        if 'town_name' in result_df.columns and len(numeric_cols) > 0 and result_df['town_name'].nunique() > 1:
+            render_pydeck_map(result_df, numeric_cols)
 
 elif st.session_state.result_df is not None:
     st.warning("⚠️ 結果が0件でした。質問を変えてみてください。")
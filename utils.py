@@ -1,13 +1,29 @@
 import streamlit as st
 import duckdb
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from openai import OpenAI
+import openai
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 import geopandas as gpd
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Iterable
 import logging
 import re
-import json
+import datetime
+import io
+import hashlib
+import sqlite3
+import os
+from contextlib import closing
+import threading
+import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +39,7 @@ MODEL_CONFIG = {
 # --- 定数定義 ---
 TABLE_SCHEMA = """
 CREATE TABLE business_stats("year" INTEGER, town_name VARCHAR, industry_name VARCHAR, num_offices INTEGER, num_employees INTEGER);
-CREATE TABLE population("year" BIGINT, town_name VARCHAR, num_households BIGINT, num_population BIGINT, num_male BIGINT, num_female BIGINT);
+CREATE TABLE population("year" INTEGER, town_name VARCHAR, num_households INTEGER, num_population INTEGER, num_male INTEGER, num_female INTEGER);
 CREATE TABLE crimes("year" BIGINT, town_name VARCHAR, major_crime VARCHAR, minor_crime VARCHAR, crime_count BIGINT);
 """
 
@@ -83,7 +99,8 @@ CRIMES_TYPES = """
 その他:その他知能犯,
 """
 
-PROMPT_TEMPLATE = f"""
+# 質問に依存しない静的な前半部分。Geminiのコンテキストキャッシュに登録して再利用する
+PROMPT_PREFIX = f"""
 あなたは優秀なデータアナリストです。八王子市に関する以下のテーブル定義とカラム情報を参考に、ユーザーからの質問をDuckDBで実行可能なSQLクエリに変換してください。
 SQLクエリのみを生成し、他の説明文は含めないでください。
 
@@ -108,15 +125,177 @@ SQLクエリのみを生成し、他の説明文は含めないでください
 - LIMIT句はデフォルトで120を指定（明示的に指定がある場合はそちらを優先する）
 - 日本語のカラム名は英語名に変換してください（例: 事業所数 → num_offices）
 - 取得結果には必ず数値カラムを含めてください（例: num_population, crime_countなど）
+"""
 
+# 質問ごとに送信する後半部分
+PROMPT_QUESTION_TEMPLATE = """
 ### ユーザーの質問
-{{user_question}}
+{user_question}
 
 ### SQLクエリ（SQLのみ出力、説明不要）
 """
 
+PROMPT_TEMPLATE = PROMPT_PREFIX + PROMPT_QUESTION_TEMPLATE
+
+# コンテキストキャッシュの保持期間
+PROMPT_CACHE_TTL = datetime.timedelta(hours=1)
+
+# プロンプトのバージョン。テンプレートを変更すると生成SQLのキャッシュキーも変わる
+PROMPT_TEMPLATE_VERSION = hashlib.sha256(PROMPT_TEMPLATE.encode('utf-8')).hexdigest()[:16]
+
+# LLMの応答（生成SQL・分析コメント）を永続化するキャッシュDB（プロセス再起動後も再利用する）
+LLM_CACHE_PATH = os.path.join('.cache', 'llm_cache.sqlite')
+# キャッシュした応答の有効期間と保持件数の上限（古いものから削除する）
+LLM_CACHE_TTL = datetime.timedelta(days=30)
+LLM_CACHE_MAX_ENTRIES = 5000
+
+# 生成したSQLが実行できない場合に、まとめて生成し直す候補の数と温度
+SQL_CANDIDATE_COUNT = 3
+SQL_CANDIDATE_TEMPERATURE = 0.2
+
+# 一時的なエラー（レート制限・サーバーエラー）の場合に再試行するAPI例外
+RETRYABLE_API_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# LLMへのリクエスト数の上限（1分あたり）。プロセス内の全セッションで共有する
+LLM_REQUESTS_PER_MINUTE = 60
+
+# 言い換えの質問に生成済みSQLを再利用するための埋め込みキャッシュ
+SEMANTIC_CACHE_PATH = os.path.join('.cache', 'semantic_sql_cache.npz')
+SEMANTIC_EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_SIMILARITY_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_ENTRIES = 10000
+# ディスクへの書き出し間隔（秒）。追加のたびにファイル全体を書き直さない
+SEMANTIC_CACHE_SAVE_INTERVAL = 60
+
+# 質問文中の数値（年度・件数など）。数値が異なる質問は言い換えとみなさない
+NUMBER_PATTERN = re.compile(r'\d+')
+
+# DuckDBの接続設定。コンテナのCPU数を超えてスレッドを立てず、メモリ使用量にも上限を設ける
+DUCKDB_CONFIG = {
+    'threads': min(4, os.cpu_count() or 2),
+    'memory_limit': '1GB',
+}
+
+# extract_query_parameters で使うパターン（年度・町名の条件・業種名）
+YEAR_PATTERN = re.compile(r'\b(20\d{2})\b')
+TOWN_FILTER_PATTERN = re.compile(r"town_name\s*=\s*'([^']+)'")
+INDUSTRY_KEYWORDS = [name.strip() for name in INDUSTRY_NAMES.split(',') if name.strip()]
+INDUSTRY_PATTERN = re.compile('|'.join(map(re.escape, sorted(INDUSTRY_KEYWORDS, key=len, reverse=True))))
+
+# セマンティックキャッシュで質問を区別する条件語（業種名とその一部・犯罪分類・データの種類）
+# 数値以外でもこれらが異なる質問は、文面が似ていても別のSQLになるため言い換えとみなさない
+SEMANTIC_KEY_TERMS = (
+    set(INDUSTRY_KEYWORDS)
+    | {part for name in INDUSTRY_KEYWORDS for part in re.split(r'[_･]', name) if len(part) >= 2}
+    | {crime for line in CRIMES_TYPES.split(',') for crime in line.strip().split(':') if crime and crime != 'その他'}
+    | {'事業所', '従業者', '世帯', '人口', '男性', '女性', '犯罪', '密度', '比率', '割合', '規模'}
+)
+SEMANTIC_KEY_PATTERN = re.compile('|'.join(map(re.escape, sorted(SEMANTIC_KEY_TERMS, key=len, reverse=True))))
+
+# 並び順を表す語。上位・下位が異なる質問も言い換えとみなさない
+SORT_DIRECTION_KEYWORDS = {
+    '多い': 'desc', '上位': 'desc', 'トップ': 'desc', '高い': 'desc', '大きい': 'desc', '最大': 'desc', '降順': 'desc',
+    '少ない': 'asc', '下位': 'asc', '低い': 'asc', '小さい': 'asc', '最小': 'asc', '昇順': 'asc',
+}
+SORT_DIRECTION_PATTERN = re.compile('|'.join(map(re.escape, SORT_DIRECTION_KEYWORDS)))
+
+# 派生指標の計算が必要な質問を判定するキーワード
+METRIC_KEYWORDS = ['密度', '比率', '割合', '世帯', '人口', '従業者', 'あたり', '指標']
+METRIC_QUESTION_PATTERN = re.compile('|'.join(map(re.escape, METRIC_KEYWORDS)))
+
+# 派生指標のカラム
+METRIC_COLUMNS = ['office_density', 'employee_ratio', 'office_size', 'offices_per_1000_pop']
+
+# 詳細な指標データの表に表示するカラムと、その日本語名（表示順）
+METRICS_DISPLAY_RENAME_MAP = {
+    'year': '年度',
+    'town_name': '町名',
+    'num_offices': '事業所数',
+    'num_employees': '従業者数',
+    'num_households': '世帯数',
+    'num_population': '人口数',
+    'office_density': '事業所密度',
+    'employee_ratio': '従業者比率',
+    'office_size': '事業所規模',
+    'offices_per_1000_pop': '人口千人あたり事業所数'
+}
+
+# 詳細な指標データの表で、派生指標を小数4桁で表示する（データは丸めず、表示側で書式を指定する）
+METRICS_COLUMN_CONFIG = {
+    METRICS_DISPLAY_RENAME_MAP[col]: st.column_config.NumberColumn(format="%.4f") for col in METRIC_COLUMNS
+}
+
+# 事業所データと人口データを結合し、派生指標を計算するクエリ（起動後に一度だけ実行して保持する）
+METRICS_SQL = """
+    SELECT
+        year,
+        town_name,
+        b.industry_name,
+        b.num_offices,
+        b.num_employees,
+        p.num_households,
+        p.num_population,
+        -- 表示は小数4桁程度なので、指標は単精度（REAL）で保持する
+        (b.num_offices::DOUBLE / NULLIF(p.num_households, 0))::REAL AS office_density,
+        (b.num_employees::DOUBLE / NULLIF(p.num_population, 0))::REAL AS employee_ratio,
+        (b.num_employees::DOUBLE / NULLIF(b.num_offices, 0))::REAL AS office_size,
+        (b.num_offices::DOUBLE / NULLIF(p.num_population, 0) * 1000)::REAL AS offices_per_1000_pop
+    FROM business_stats b
+    JOIN population p USING (year, town_name)
+"""
+
+# LLMの応答に含まれるコードフェンス
+SQL_FENCE_PATTERN = re.compile(r'```(?:sql)?', re.IGNORECASE)
+
+# 指標の解釈に使う閾値（昇順）と、区間ごとのコメント
+DENSITY_EDGES = np.array([0.05, 0.1])
+DENSITY_MSGS = [
+    "🏘️ 事業所密度が低め（{:.3f}）で、住宅地中心のエリアです。",
+    "📊 事業所密度は標準的（{:.3f}）です。",
+    "🏢 事業所密度が高水準（{:.3f}）で、商業活動が活発です。",
+]
+RATIO_EDGES = np.array([0.2, 0.3])
+RATIO_MSGS = [
+    "🏠 従業者比率が低め（{:.3f}）です。",
+    "👔 従業者比率は標準的（{:.3f}）です。",
+    "💼 従業者比率が高く（{:.3f}）、雇用が活発です。",
+]
+SIZE_EDGES = np.array([10])
+SIZE_MSGS = [
+    "🏪 平均事業所規模は小さめ（{:.1f}人/所）で、小規模事業所中心です。",
+    "🏭 平均事業所規模が大きく（{:.1f}人/所）、中規模以上の企業が多いです。",
+]
+
+# 解釈コメントを生成する指標と、その閾値・コメントの対応（この順に出力する）
+INTERPRETATION_RULES = [
+    ('office_density', DENSITY_EDGES, DENSITY_MSGS),
+    ('employee_ratio', RATIO_EDGES, RATIO_MSGS),
+    ('office_size', SIZE_EDGES, SIZE_MSGS),
+]
+
 # --- AI関連 ---
 
+@st.cache_resource(show_spinner=False)
+def create_model_client(provider: str, model_name: str, api_key: str) -> Any:
+    """生成AIモデルのクライアントを作成し、再実行をまたいで使い回す"""
+    if provider == "google":
+        genai.configure(api_key=api_key)
+        # Googleモデルはモデル名で初期化
+        return genai.GenerativeModel(model_name)
+    # OpenRouterモデルはクライアントを返す（モデル名は後で指定）
+    return OpenAI(
+        api_key=api_key,
+        base_url="https://openrouter.ai/api/v1"
+    )
+
 def get_generative_model(model_name: str) -> Optional[Any]:
     """選択されたモデル名に基づいて、設定済みの生成AIモデルクライアントを返す"""
     if model_name not in MODEL_CONFIG:
@@ -132,20 +311,14 @@ def get_generative_model(model_name: str) -> Optional[Any]:
             if not api_key:
                 st.error("⚠️ GOOGLE_API_KEYが設定されていません。")
                 return None
-            genai.configure(api_key=api_key)
-            # Googleモデルはモデル名で初期化
-            return genai.GenerativeModel(model_name)
+            return create_model_client(provider, model_name, api_key)
         
         elif provider == "openrouter":
             api_key = st.secrets.get("OPENROUTER_API_KEY")
             if not api_key:
                 st.error("⚠️ OPENROUTER_API_KEYが設定されていません。")
                 return None
-            # OpenRouterモデルはクライアントを返す（モデル名は後で指定）
-            return OpenAI(
-                api_key=api_key,
-                base_url="https://openrouter.ai/api/v1"
-            )
+            return create_model_client(provider, model_name, api_key)
         else:
             st.error(f"❌ 不明なプロバイダーです: {provider}")
             return None
@@ -154,51 +327,451 @@ def get_generative_model(model_name: str) -> Optional[Any]:
         logger.error(f"モデル初期化エラー ({model_name}): {e}")
         return None
 
-def generate_sql(question: str, model_name: str) -> Optional[str]:
-    """ユーザーの質問からSQLを生成する"""
+# キャッシュ側の期限切れより少し早く作り直す
+@st.cache_resource(ttl=PROMPT_CACHE_TTL - datetime.timedelta(minutes=5), show_spinner=False)
+def get_prompt_cached_model(model_name: str) -> Optional[Any]:
+    """静的なプロンプト部分をGeminiのコンテキストキャッシュに登録し、それを参照するモデルを返す"""
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=f"models/{model_name}",
+            display_name="hachi-sql-prompt",
+            contents=[PROMPT_PREFIX],
+            ttl=PROMPT_CACHE_TTL,
+        )
+        logger.info(f"コンテキストキャッシュを作成しました ({model_name}): {cached_content.name}")
+        return genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+    except Exception as e:
+        # 最小トークン数に満たない場合など。通常のプロンプト送信にフォールバックする
+        logger.warning(f"コンテキストキャッシュを利用できません ({model_name}): {e}")
+        return None
+
+def generate_sql(question: str, model_name: str, on_chunk: Optional[Callable[[str], None]] = None) -> Optional[str]:
+    """ユーザーの質問からSQLを生成する（同じ質問の結果はキャッシュから返す）
+
+    on_chunkを指定すると、生成途中のテキストを受け取るたびに呼び出す。
+    """
+    question = question.strip()
+    cache_key = _sql_cache_key(question, model_name)
+    sql_query = _load_cached_response(cache_key)
+    if sql_query is not None:
+        logger.info(f"SQLキャッシュヒット ({model_name}): {sql_query}")
+        return sql_query
+    # 言い換えの質問であれば、埋め込みの類似度から過去のSQLを再利用する
+    # 埋め込みはGoogleのAPIで計算するため、Googleのモデルを使う場合だけ類似質問を探す
+    use_semantic_cache = MODEL_CONFIG.get(model_name, {}).get("provider") == "google"
+    semantic_cache = get_semantic_sql_cache() if use_semantic_cache else None
+    semantic_key = SemanticSQLCache.entry_key(question, model_name) if use_semantic_cache else None
+    semantic_hit = threading.Event()
+    semantic_sql: list[str] = []
+
+    def lookup_semantic_cache() -> Optional[np.ndarray]:
+        """質問文を埋め込み、類似した質問のSQLが見つかればSQL生成の打ち切りを知らせる"""
+        embedding = embed_question(question)
+        if embedding is not None:
+            cached_sql = semantic_cache.lookup(embedding, semantic_key)
+            if cached_sql is not None:
+                semantic_sql.append(cached_sql)
+                semantic_hit.set()
+        return embedding
+
+    # 埋め込みの取得を待ってから生成を始めると待ち時間が積み重なるため、SQL生成と並行して検索する
+    with ThreadPoolExecutor(max_workers=1, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+        embedding_future = executor.submit(lookup_semantic_cache) if use_semantic_cache else None
+        sql_query, is_valid = _generate_sql_uncached(question, model_name, on_chunk, stop_event=semantic_hit)
+        embedding = embedding_future.result() if embedding_future is not None else None
+
+    if semantic_hit.is_set() and not is_valid:
+        # 類似度による一致は誤りの可能性があるため、完全一致のキャッシュには昇格させない
+        logger.info(f"セマンティックキャッシュヒット ({model_name}): {semantic_sql[0]}")
+        return semantic_sql[0]
+    # 検証を通らなかったSQLをキャッシュすると、同じ質問が常に失敗するようになるため保存しない
+    if sql_query and is_valid:
+        _store_cached_response(cache_key, sql_query)
+        if embedding is not None and not semantic_hit.is_set():
+            semantic_cache.add(embedding, semantic_key, sql_query)
+    return sql_query
+
+def _sql_cache_key(question: str, model_name: str) -> str:
+    """モデル名・プロンプトのバージョン・質問文からキャッシュキーを作る"""
+    return hashlib.sha256(f"{model_name}\0{PROMPT_TEMPLATE_VERSION}\0{question}".encode('utf-8')).hexdigest()
+
+def _summary_cache_key(prompt: str, model_name: str) -> str:
+    """モデル名と分析コメント用のプロンプト（質問文とデータサンプルを含む）からキャッシュキーを作る"""
+    return hashlib.sha256(f"summary\0{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def _init_llm_cache() -> bool:
+    """LLM応答キャッシュ用のSQLiteテーブルを作成する"""
+    try:
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH), exist_ok=True)
+        with closing(sqlite3.connect(LLM_CACHE_PATH)) as con, con:
+            con.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at TEXT NOT NULL)")
+            con.execute("CREATE INDEX IF NOT EXISTS llm_cache_created_at ON llm_cache (created_at)")
+        return True
+    except Exception as e:
+        logger.warning(f"LLM応答キャッシュを初期化できません: {e}")
+        return False
+
+def _load_cached_response(cache_key: str) -> Optional[str]:
+    """SQLiteのキャッシュからLLMの応答を取得する（有効期間を過ぎたものは使わない）"""
+    if not _init_llm_cache():
+        return None
+    try:
+        expires_before = (datetime.datetime.now() - LLM_CACHE_TTL).isoformat()
+        with closing(sqlite3.connect(LLM_CACHE_PATH)) as con:
+            row = con.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?",
+                (cache_key, expires_before),
+            ).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.warning(f"LLM応答キャッシュの読み込みに失敗しました: {e}")
+        return None
+
+def _store_cached_response(cache_key: str, response: str) -> None:
+    """LLMの応答をSQLiteのキャッシュに保存し、期限切れと上限を超えた古い応答を削除する"""
+    if not _init_llm_cache():
+        return
+    try:
+        now = datetime.datetime.now()
+        with closing(sqlite3.connect(LLM_CACHE_PATH)) as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, created_at) VALUES (?, ?, ?)",
+                (cache_key, response, now.isoformat()),
+            )
+            con.execute(
+                "DELETE FROM llm_cache WHERE created_at < ? OR key NOT IN "
+                "(SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT ?)",
+                ((now - LLM_CACHE_TTL).isoformat(), LLM_CACHE_MAX_ENTRIES),
+            )
+    except Exception as e:
+        logger.warning(f"LLM応答キャッシュの保存に失敗しました: {e}")
+
+class SemanticSQLCache:
+    """質問文の埋め込みベクトルと生成SQLを保持し、類似した質問にSQLを再利用する"""
+
+    def __init__(self, path: str = SEMANTIC_CACHE_PATH, threshold: float = SEMANTIC_SIMILARITY_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, save_interval: float = SEMANTIC_CACHE_SAVE_INTERVAL):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_saved = time.monotonic()
+        self._reset(0)
+        self._load()
+        # 間引いて保存しているため、終了時に未保存の追加分を書き出す
+        atexit.register(self.flush)
+
+    def _reset(self, dim: int) -> None:
+        """空のキャッシュを用意する"""
+        self._size = 0
+        self._embeddings = np.empty((0, dim), dtype=np.float32)
+        self._sqls = np.empty(0, dtype=object)
+        self._keys = np.empty(0, dtype=object)
+        self._last_used = np.empty(0, dtype=np.float64)
+
+    def _reserve(self, size: int) -> None:
+        """追加のたびに配列全体を作り直さないよう、容量を倍々に確保する"""
+        capacity = len(self._sqls)
+        if size <= capacity:
+            return
+        capacity = min(max(size, capacity * 2, 64), self.max_entries)
+        embeddings = np.empty((capacity, self._embeddings.shape[1]), dtype=np.float32)
+        embeddings[:self._size] = self._embeddings[:self._size]
+        self._embeddings = embeddings
+        for name, dtype in (('_sqls', object), ('_keys', object), ('_last_used', np.float64)):
+            array = np.empty(capacity, dtype=dtype)
+            array[:self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, array)
+
+    def _load(self) -> None:
+        """ディスクからキャッシュを読み込む（プロンプトのバージョンが異なる場合は破棄）"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            # 文字列は固定長の配列で保存しているため、pickleの読み込みは許可しない
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data['version']) != PROMPT_TEMPLATE_VERSION:
+                    return
+                self._embeddings = data['embeddings'].astype(np.float32)
+                self._sqls = data['sqls'].astype(object)
+                self._keys = data['keys'].astype(object)
+                self._last_used = data['last_used'].astype(np.float64)
+                self._size = len(self._sqls)
+        except Exception as e:
+            logger.warning(f"セマンティックキャッシュの読み込みに失敗しました: {e}")
+            self._reset(0)
+
+    def _snapshot(self) -> dict[str, np.ndarray]:
+        """保存用に現在の内容をコピーする（ロックを保持した状態で呼び出す）"""
+        size = self._size
+        self._dirty = False
+        self._last_saved = time.monotonic()
+        return {
+            'embeddings': self._embeddings[:size].copy(),
+            'sqls': self._sqls[:size].astype(str),
+            'keys': self._keys[:size].astype(str),
+            'last_used': self._last_used[:size].copy(),
+        }
+
+    def _write(self, snapshot: dict[str, np.ndarray]) -> None:
+        """キャッシュをディスクに書き出す（書き込み中も検索・追加はブロックしない）"""
+        with self._save_lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = self.path + '.tmp.npz'
+                np.savez(tmp_path, version=PROMPT_TEMPLATE_VERSION, **snapshot)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning(f"セマンティックキャッシュの保存に失敗しました: {e}")
+
+    def flush(self) -> None:
+        """未保存の追加分があればディスクに書き出す"""
+        with self._lock:
+            snapshot = self._snapshot() if self._dirty else None
+        if snapshot is not None:
+            self._write(snapshot)
+
+    @staticmethod
+    def entry_key(question: str, model_name: str) -> str:
+        """モデル名と質問中の数値・条件語・町名・並び順の組。これが一致するエントリだけを類似度の比較対象にする"""
+        town_pattern = get_town_name_pattern()
+        towns = sorted(set(town_pattern.findall(question))) if town_pattern is not None else []
+        terms = sorted(set(SEMANTIC_KEY_PATTERN.findall(question)))
+        directions = sorted({SORT_DIRECTION_KEYWORDS[word] for word in SORT_DIRECTION_PATTERN.findall(question)})
+        return "\0".join([
+            model_name,
+            ','.join(NUMBER_PATTERN.findall(question)),
+            ','.join(terms),
+            ','.join(towns),
+            ','.join(directions),
+        ])
+
+    def lookup(self, embedding: np.ndarray, key: str) -> Optional[str]:
+        """類似度が閾値以上の質問があれば、そのSQLを返す"""
+        with self._lock:
+            size = self._size
+            if size == 0 or self._embeddings.shape[1] != embedding.shape[0]:
+                return None
+            scores = self._embeddings[:size] @ embedding
+            scores[self._keys[:size] != key] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self._last_used[best] = time.time()
+            return self._sqls[best]
+
+    def add(self, embedding: np.ndarray, key: str, sql_query: str) -> None:
+        """質問の埋め込みと生成SQLを追加する（上限に達したら最も長く使われていないものと置き換える）"""
+        with self._lock:
+            if self._embeddings.shape[1] != embedding.shape[0]:
+                self._reset(embedding.shape[0])
+            if self._size < self.max_entries:
+                self._reserve(self._size + 1)
+                index = self._size
+                self._size += 1
+            else:
+                index = int(np.argmin(self._last_used[:self._size]))
+            self._embeddings[index] = embedding
+            self._sqls[index] = sql_query
+            self._keys[index] = key
+            self._last_used[index] = time.time()
+            self._dirty = True
+            # ディスクへの書き出しは一定間隔ごとにまとめて行う
+            snapshot = self._snapshot() if time.monotonic() - self._last_saved >= self.save_interval else None
+        if snapshot is not None:
+            self._write(snapshot)
+
+@st.cache_resource(show_spinner=False)
+def get_town_name_pattern() -> Optional[re.Pattern]:
+    """データに含まれる町名のいずれかに一致するパターンを返す（長い町名を優先する）"""
+    try:
+        con = get_db_connection()
+        if con is None:
+            return None
+        with con.cursor() as cursor:
+            rows = cursor.execute("SELECT DISTINCT town_name FROM population WHERE town_name IS NOT NULL").fetchall()
+        town_names = sorted((row[0] for row in rows), key=len, reverse=True)
+        return re.compile('|'.join(map(re.escape, town_names))) if town_names else None
+    except Exception as e:
+        logger.warning(f"町名の一覧を取得できません: {e}")
+        return None
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_sql_cache() -> SemanticSQLCache:
+    """プロセス内で共有するセマンティックキャッシュを返す"""
+    return SemanticSQLCache()
+
+def embed_question(question: str) -> Optional[np.ndarray]:
+    """質問文をGeminiの埋め込みモデルでL2正規化済みのベクトルに変換する"""
+    try:
+        api_key = st.secrets.get("GOOGLE_API_KEY")
+        if not api_key:
+            return None
+        genai.configure(api_key=api_key)
+        result = genai.embed_content(model=SEMANTIC_EMBEDDING_MODEL, content=question, task_type="SEMANTIC_SIMILARITY")
+        embedding = np.asarray(result['embedding'], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else None
+    except Exception as e:
+        logger.warning(f"質問文の埋め込みに失敗しました: {e}")
+        return None
+
+def _collect_stream(chunks: Iterable[str], on_chunk: Optional[Callable[[str], None]],
+                    stop_event: Optional[threading.Event] = None) -> str:
+    """ストリーミング応答のテキストを連結し、途中経過をon_chunkに渡す（stop_eventが立ったら打ち切る）"""
+    buffer = ""
+    for text in chunks:
+        if stop_event is not None and stop_event.is_set():
+            break
+        if not text:
+            continue
+        buffer += text
+        if on_chunk is not None:
+            on_chunk(buffer)
+        # コードブロックが閉じた時点でSQLは完結しているので、残りの生成は待たない
+        if buffer.count("```") >= 2:
+            break
+    return buffer
+
+class RequestThrottle:
+    """トークンバケット方式でリクエスト頻度を制限する"""
+
+    def __init__(self, rate_per_minute: int = LLM_REQUESTS_PER_MINUTE):
+        self.capacity = rate_per_minute
+        self.refill_per_second = rate_per_minute / 60
+        self._tokens = float(rate_per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンが補充されるまで待ってから1つ消費する"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_second)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.refill_per_second
+            time.sleep(wait)
+
+@st.cache_resource(show_spinner=False)
+def get_request_throttle() -> RequestThrottle:
+    """プロセス内で共有するリクエスト制限を返す"""
+    return RequestThrottle()
+
+@retry(
+    retry=retry_if_exception_type(RETRYABLE_API_ERRORS),
+    wait=wait_random_exponential(min=1, max=10),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+def _request_sql_text(model_client: Any, provider: str, model_name: str, question_prompt: str,
+                      on_chunk: Optional[Callable[[str], None]] = None,
+                      stop_event: Optional[threading.Event] = None) -> str:
+    """LLMにSQLの生成をリクエストし、ストリーミング応答のテキストを返す（一時的なエラーは再試行する）"""
+    get_request_throttle().acquire()
+    if provider == "google":
+        response = None
+        cached_model = get_prompt_cached_model(model_name)
+        if cached_model is not None:
+            try:
+                response = cached_model.generate_content(question_prompt, stream=True)
+            except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as e:
+                # キャッシュが期限切れ・削除済みの場合は作り直し、今回は通常のプロンプトで実行する
+                logger.warning(f"コンテキストキャッシュが無効です ({model_name}): {e}")
+                get_prompt_cached_model.clear()
+        if response is None:
+            # 静的な前半部分を独立したパートとして送り、暗黙的なプレフィックスキャッシュを効かせる
+            response = model_client.generate_content([PROMPT_PREFIX, question_prompt], stream=True)
+        return _collect_stream((chunk.text for chunk in response if chunk.parts), on_chunk, stop_event)
+    response = model_client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": PROMPT_PREFIX + question_prompt}],
+        stream=True
+    )
+    return _collect_stream((chunk.choices[0].delta.content for chunk in response if chunk.choices), on_chunk, stop_event)
+
+def _generate_sql_uncached(question: str, model_name: str, on_chunk: Optional[Callable[[str], None]] = None,
+                           stop_event: Optional[threading.Event] = None) -> tuple[Optional[str], bool]:
+    """ユーザーの質問からSQLを生成し、SQLと検証を通ったかどうかを返す
+
+    stop_eventが立った場合（キャッシュから再利用できるSQLが見つかった場合）は生成を打ち切る。
+    """
     model_client = get_generative_model(model_name)
     if model_client is None:
-        return None
+        return None, False
         
     try:
-        prompt = PROMPT_TEMPLATE.format(user_question=question)
+        question_prompt = PROMPT_QUESTION_TEMPLATE.format(user_question=question)
         
         provider = MODEL_CONFIG[model_name]["provider"]
 
-        if provider == "google":
-            response = model_client.generate_content(prompt)
-            sql_query = response.text
-        elif provider == "openrouter":
-            response = model_client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            sql_query = response.choices[0].message.content
-        else:
+        if provider not in ("google", "openrouter"):
             st.error(f"❌ サポートされていないプロバイダーです: {provider}")
-            return None
+            return None, False
+        sql_query = _request_sql_text(model_client, provider, model_name, question_prompt, on_chunk, stop_event)
+        if stop_event is not None and stop_event.is_set():
+            return None, False
 
-        sql_query = sql_query.strip().replace("```sql", "").replace("```", "").strip()
+        sql_query = SQL_FENCE_PATTERN.sub("", sql_query).strip()
         logger.info(f"生成されたSQL ({model_name}): {sql_query}")
-        return sql_query
+
+        if validate_sql(sql_query):
+            return sql_query, True
+        # 実行できないSQLだった場合は、1回のリクエストで複数の候補を生成し、最初に検証を通ったものを使う
+        logger.warning(f"生成されたSQLを実行できないため、候補を再生成します ({model_name})")
+        for candidate in _generate_sql_candidates(model_client, provider, model_name, question_prompt):
+            if validate_sql(candidate):
+                logger.info(f"再生成したSQL ({model_name}): {candidate}")
+                return candidate, True
+        # どの候補も検証を通らなかった場合は、エラー表示のために元のSQLを返す（キャッシュはしない）
+        return sql_query, False
 
     except Exception as e:
         st.error(f"❌ SQLの生成に失敗しました: {e}")
         logger.error(f"SQL生成エラー ({model_name}): {e}")
-        return None
+        return None, False
+
+def _generate_sql_candidates(model_client: Any, provider: str, model_name: str, question_prompt: str) -> list[str]:
+    """1回のリクエストで複数のSQL候補を生成する"""
+    try:
+        get_request_throttle().acquire()
+        if provider == "google":
+            response = model_client.generate_content(
+                [PROMPT_PREFIX, question_prompt],
+                generation_config=genai.GenerationConfig(
+                    candidate_count=SQL_CANDIDATE_COUNT,
+                    temperature=SQL_CANDIDATE_TEMPERATURE
+                )
+            )
+            texts = ["".join(part.text for part in candidate.content.parts) for candidate in response.candidates]
+        else:
+            response = model_client.chat.completions.create(
+                model=model_name,
+                messages=[{"role": "user", "content": PROMPT_PREFIX + question_prompt}],
+                n=SQL_CANDIDATE_COUNT,
+                temperature=SQL_CANDIDATE_TEMPERATURE
+            )
+            texts = [choice.message.content or "" for choice in response.choices]
+        return [SQL_FENCE_PATTERN.sub("", text).strip() for text in texts]
+    except Exception as e:
+        logger.warning(f"SQL候補の生成に失敗しました ({model_name}): {e}")
+        return []
 
 def generate_ai_summary(df: pd.DataFrame, user_question: str, model_name: str) -> str:
     """分析結果をもとにAIが自然言語で傾向を説明する"""
     if df is None or df.empty:
         return "データが見つかりませんでした。"
 
-    model_client = get_generative_model(model_name)
-    if model_client is None:
-        return "AIモデルの初期化に失敗しました。"
-
     try:
-        sample_data = df.head(30).to_dict(orient="records")
-        data_str = json.dumps(sample_data, ensure_ascii=False)
+        # pandasのJSONライタで直接シリアライズする（行ごとのdictを作らず、区切りの空白も出力しない）
+        data_str = df.head(30).to_json(orient="records", force_ascii=False)
 
         prompt = f"""
 次の質問とデータに基づいて、八王子市に関する分析結果を日本語で説明してください。
@@ -210,6 +783,16 @@ def generate_ai_summary(df: pd.DataFrame, user_question: str, model_name: str) -
 - 主な傾向・特徴・注目すべき点を述べる。
 - 数値や町名が明確な場合はそれを挙げる。
 """
+        # 同じ質問・同じデータに対するコメントはキャッシュから返す
+        cache_key = _summary_cache_key(prompt, model_name)
+        summary = _load_cached_response(cache_key)
+        if summary is not None:
+            return summary
+
+        model_client = get_generative_model(model_name)
+        if model_client is None:
+            return "AIモデルの初期化に失敗しました。"
+
         provider = MODEL_CONFIG[model_name]["provider"]
 
         if provider == "google":
@@ -223,8 +806,10 @@ def generate_ai_summary(df: pd.DataFrame, user_question: str, model_name: str) -
             summary = response.choices[0].message.content
         else:
             return f"サポートされていないプロバイダーです: {provider}"
-            
-        return summary.strip()
+
+        summary = summary.strip()
+        _store_cached_response(cache_key, summary)
+        return summary
 
     except Exception as e:
         logger.error(f"AI要約生成エラー ({model_name}): {e}")
@@ -236,17 +821,57 @@ def generate_ai_summary(df: pd.DataFrame, user_question: str, model_name: str) -
 def get_db_connection():
     """データベース接続をキャッシュして再利用"""
     try:
-        return duckdb.connect('hachi_office.duckdb', read_only=True)
+        return duckdb.connect('hachi_office.duckdb', read_only=True, config=DUCKDB_CONFIG)
     except Exception as e:
         logger.error(f"データベース接続エラー: {e}")
         st.error(f"データベース接続エラー: {e}")
         return None
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
+def get_metrics_table() -> Optional[pa.Table]:
+    """派生指標を全件計算してArrowのTableとして保持する（元データは静的なため再計算しない）"""
+    try:
+        con = get_db_connection()
+        if con is None:
+            return None
+        with con.cursor() as cursor:
+            table = cursor.execute(METRICS_SQL).fetch_arrow_table()
+        logger.info(f"派生指標を事前計算しました: {table.num_rows}行")
+        return table
+    except Exception as e:
+        logger.error(f"派生指標の事前計算エラー: {e}")
+        return None
+
+def fetch_dataframe(result: duckdb.DuckDBPyConnection) -> pd.DataFrame:
+    """クエリ結果をArrow経由で取得し、DataFrameに変換する"""
+    table = result.fetch_arrow_table()
+    # HUGEINT（SUMの結果など）はdecimal128になるため、fetchdf()と同様にfloat64へ揃える
+    schema = pa.schema([
+        field.with_type(pa.float64()) if pa.types.is_decimal(field.type) else field
+        for field in table.schema
+    ])
+    # 文字列カラムはPythonオブジェクトに変換せず、Arrowのバッファのまま保持する
+    # 変換後のTableは使わないので、列ごとのブロックに分けて変換済みの列から解放する
+    return table.cast(schema).to_pandas(
+        split_blocks=True,
+        self_destruct=True,
+        types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_string(t) or pa.types.is_large_string(t) else None
+    )
+
+@st.cache_data(show_spinner=False)
+def convert_df_to_csv(df: pd.DataFrame) -> bytes:
+    """DataFrameをExcelで開けるBOM付きUTF-8のCSVに変換する"""
+    buffer = io.BytesIO()
+    pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return b'\xef\xbb\xbf' + buffer.getvalue()
+
+# 呼び出しごとのコピー（デシリアライズ）を避けるため、読み込んだGeoDataFrameを共有する。呼び出し側で変更しないこと
+@st.cache_resource
 def load_geojson_data() -> Optional[gpd.GeoDataFrame]:
     """GeoJSONデータを読み込み、キャッシュする"""
     try:
-        gdf = gpd.read_file('geojson/hachiouji_aza_simplified.geojson')
+        # 使うのは町名と形状だけなので、他の属性は読み込まない
+        gdf = gpd.read_file('geojson/hachiouji_aza_simplified.geojson', columns=['S_NAME'])
         gdf = gdf[['S_NAME', 'geometry']].rename(columns={'S_NAME': 'town_name'})
         if gdf.crs is None:
             gdf = gdf.set_crs(epsg=4326)
@@ -259,31 +884,35 @@ def load_geojson_data() -> Optional[gpd.GeoDataFrame]:
         st.error(f"GeoJSONの読み込みに失敗しました: {e}")
         return None
 
-def get_all_data(table_name: str) -> Optional[pd.DataFrame]:
-    """指定テーブルの全データを取得"""
-    try:
-        con = get_db_connection()
-        if con is None:
-            return None
-        return con.execute(f"SELECT * FROM {table_name}").fetchdf()
-    except Exception as e:
-        logger.error(f"データ取得エラー ({table_name}): {e}")
+# load_geojson_data と同様に、再実行ごとのデシリアライズを避けて共有する。呼び出し側で変更しないこと
+@st.cache_resource(show_spinner=False)
+def load_polygon_data() -> Optional[pd.DataFrame]:
+    """pydeckのPolygonLayer用に、町名ごとのポリゴン座標をリストに展開して返す"""
+    gdf = load_geojson_data()
+    if gdf is None:
         return None
+    # MultiPolygonは構成ポリゴンごとの行に分け、外周と穴の座標を [[lon, lat], ...] のリストにする
+    polygons = gdf.explode(index_parts=False, ignore_index=True)
+    coordinates = [
+        [[list(coord) for coord in ring.coords] for ring in (polygon.exterior, *polygon.interiors)]
+        for polygon in polygons.geometry
+    ]
+    return pd.DataFrame({'town_name': polygons['town_name'].to_numpy(), 'coordinates': coordinates})
 
-def execute_query(sql_query: str) -> Optional[pd.DataFrame]:
-    """DuckDBでSQLを実行し、結果をDataFrameで返す"""
+def execute_query(sql_query: str, params: Optional[list] = None) -> Optional[pd.DataFrame]:
+    """DuckDBでSQLを実行し、結果をDataFrameで返す（paramsは ? プレースホルダに渡す値）"""
     try:
         con = get_db_connection()
         if con is None:
             st.error("データベース接続に失敗しました")
             return None
         
-        dangerous_keywords = ['DROP', 'DELETE', 'INSERT', 'UPDATE', 'ALTER', 'CREATE']
-        if any(keyword in sql_query.upper() for keyword in dangerous_keywords):
+        if not is_single_select(sql_query):
             st.error("⚠️ 危険なSQL操作が検出されました")
             return None
         
-        df = con.execute(sql_query).fetchdf()
+        with con.cursor() as cursor:
+            df = fetch_dataframe(cursor.execute(sql_query, params))
         logger.info(f"クエリ実行成功: {len(df)}行取得")
         return df
     except Exception as e:
@@ -291,6 +920,26 @@ def execute_query(sql_query: str) -> Optional[pd.DataFrame]:
         logger.error(f"SQL実行エラー: {e}\nSQL: {sql_query}")
         return None
 
+def is_single_select(sql_query: str) -> bool:
+    """DuckDBのパーサーで、SQLがSELECT文1つだけかを判定する（構文エラーは例外になる）"""
+    statements = duckdb.extract_statements(sql_query)
+    return len(statements) == 1 and statements[0].type == duckdb.StatementType.SELECT
+
+def validate_sql(sql_query: str) -> bool:
+    """SQLを実行せずに、安全かつDuckDBで解釈・計画できるかを確認する"""
+    try:
+        if not sql_query or not is_single_select(sql_query):
+            return False
+        con = get_db_connection()
+        if con is None:
+            return False
+        with con.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql_query}")
+        return True
+    except Exception as e:
+        logger.info(f"SQL検証エラー: {e}")
+        return False
+
 @st.cache_data
 def get_yearly_business_summary() -> Optional[pd.DataFrame]:
     """年度別の事業者数・従業員数を取得"""
@@ -343,51 +992,50 @@ def get_available_years() -> list[int]:
 @st.cache_data
 def get_town_business_data(year: int) -> Optional[pd.DataFrame]:
     """指定年度の町名ごと事業者数を取得"""
-    query = f"""
+    query = """
         SELECT town_name, SUM(num_offices) as num_offices, SUM(num_employees) as num_employees
         FROM business_stats 
-        WHERE year = {year}
+        WHERE year = ?
         GROUP BY town_name;
     """
-    return execute_query(query)
+    return execute_query(query, [year])
 
 @st.cache_data
 def get_town_population_data(year: int) -> Optional[pd.DataFrame]:
     """指定年度の町名ごと人口を取得"""
-    query = f"""
+    query = """
         SELECT town_name, SUM(num_households) as num_households, SUM(num_population) as num_population
         FROM population 
-        WHERE year = {year}
+        WHERE year = ?
         GROUP BY town_name;
     """
-    return execute_query(query)
+    return execute_query(query, [year])
 
 @st.cache_data
 def get_town_crime_data(year: int) -> Optional[pd.DataFrame]:
     """指定年度の町名ごと犯罪件数を取得"""
-    query = f"""
+    query = """
         SELECT town_name, SUM(crime_count) as crime_count
         FROM crimes 
-        WHERE year = {year}
+        WHERE year = ?
         GROUP BY town_name;
     """
-    return execute_query(query)
+    return execute_query(query, [year])
 
 def extract_query_parameters(sql_query: str, user_question: str) -> dict:
     """SQLクエリとユーザー質問から年度・業種・町名を抽出"""
     params = {'year': None, 'industry': None, 'town': None}
     try:
-        year_matches = re.findall(r'\b(20\d{2})\b', sql_query)
-        if year_matches:
-            params['year'] = int(year_matches[0])
+        year_match = YEAR_PATTERN.search(sql_query)
+        if year_match:
+            params['year'] = int(year_match.group(1))
         
-        industry_keywords = INDUSTRY_NAMES.replace('\n', '').replace(' ', '').split(',')
-        for industry in industry_keywords:
-            if industry and (industry in sql_query or industry in user_question):
-                params['industry'] = industry
-                break
+        # 複数の業種が含まれる場合は、一覧で先に定義されている業種を優先する
+        industries = set(INDUSTRY_PATTERN.findall(sql_query)) | set(INDUSTRY_PATTERN.findall(user_question))
+        if industries:
+            params['industry'] = min(industries, key=INDUSTRY_KEYWORDS.index)
         
-        town_match = re.search(r"town_name\s*=\s*'([^']+)'", sql_query)
+        town_match = TOWN_FILTER_PATTERN.search(sql_query)
         if town_match:
             params['town'] = town_match.group(1)
             
@@ -399,75 +1047,67 @@ def extract_query_parameters(sql_query: str, user_question: str) -> dict:
 
 def detect_metric_question(question: str) -> bool:
     """指標計算が必要な質問かを判定"""
-    keywords = ['密度', '比率', '割合', '世帯', '人口', '従業者', 'あたり', '指標']
-    return any(kw in question for kw in keywords)
+    return METRIC_QUESTION_PATTERN.search(question) is not None
 
 # --- 分析ロジック ---
 
-def calculate_derived_metrics(business_df: pd.DataFrame, population_df: pd.DataFrame, 
-                              year: int = None, industry: str = None, town: str = None) -> Optional[pd.DataFrame]:
-    """世帯数と事業所数から派生した指標を計算する"""
+@st.cache_data(ttl=3600, show_spinner=False)
+def calculate_derived_metrics(year: int = None, industry: str = None, town: str = None,
+                              result_df: Optional[pd.DataFrame] = None) -> Optional[pd.DataFrame]:
+    """世帯数と事業所数から派生した指標を、指定条件とクエリ結果の年度・町名で絞り込んで返す"""
     try:
-        if business_df.empty or population_df.empty:
+        con = get_db_connection()
+        metrics_table = get_metrics_table()
+        if con is None or metrics_table is None:
             return None
-        
-        filtered_business = business_df.copy()
+
+        query = "SELECT * FROM metrics"
+        params = []
+
+        # クエリ結果に含まれる年度・町名の組み合わせだけを結合対象にする（セミジョイン）
+        key_columns = [col for col in ['year', 'town_name'] if result_df is not None and col in result_df.columns]
+        if key_columns:
+            keys = result_df[key_columns].dropna().drop_duplicates()
+            if not keys.empty:
+                query += " SEMI JOIN (SELECT " + ", ".join(f"UNNEST(?) AS {col}" for col in key_columns) + ") keys USING (" + ", ".join(key_columns) + ")"
+                params += [keys[col].tolist() for col in key_columns]
+
+        conditions = []
         if year:
-            filtered_business = filtered_business[filtered_business['year'] == year]
+            conditions.append("year = ?")
+            params.append(year)
         if industry:
-            filtered_business = filtered_business[filtered_business['industry_name'] == industry]
+            conditions.append("industry_name = ?")
+            params.append(industry)
         if town:
-            filtered_business = filtered_business[filtered_business['town_name'] == town]
-        
-        if filtered_business.empty:
-            return None
-        
-        merged_df = pd.merge(
-            filtered_business,
-            population_df[['year', 'town_name', 'num_households', 'num_population']],
-            on=['year', 'town_name'],
-            how='inner'
-        )
+            conditions.append("town_name = ?")
+            params.append(town)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
 
-        if merged_df.empty:
+        # 事前計算済みのArrow Tableをカーソルに登録し、コピーせずに絞り込む
+        with con.cursor() as cursor:
+            cursor.register('metrics', metrics_table)
+            metrics_df = fetch_dataframe(cursor.execute(query, params))
+        if metrics_df.empty:
             return None
 
-        merged_df['office_density'] = merged_df['num_offices'] / merged_df['num_households'].replace(0, 1)
-        merged_df['employee_ratio'] = merged_df['num_employees'] / merged_df['num_population'].replace(0, 1)
-        merged_df['office_size'] = merged_df['num_employees'] / merged_df['num_offices'].replace(0, 1)
-        merged_df['offices_per_1000_pop'] = (merged_df['num_offices'] / merged_df['num_population']) * 1000
-
-        return merged_df
+        return metrics_df
     except Exception as e:
         st.error(f"❌ 指標の計算に失敗しました: {e}")
         logger.error(f"指標計算エラー: {e}")
         return None
 
-def generate_interpretation(metrics_df: pd.DataFrame) -> str:
-    """指標の解釈コメントを生成する"""
-    if metrics_df is None or metrics_df.empty:
+def generate_interpretation(means: pd.Series) -> str:
+    """指標の平均値から解釈コメントを生成する"""
+    if means is None or means.empty:
         return "解釈できるデータがありません。"
     try:
-        avg_density = metrics_df['office_density'].mean()
-        avg_ratio = metrics_df['employee_ratio'].mean()
-        avg_size = metrics_df['office_size'].mean()
-        comments = []
-        if avg_density > 0.1:
-            comments.append(f"🏢 事業所密度が高水準（{avg_density:.3f}）で、商業活動が活発です。")
-        elif avg_density > 0.05:
-            comments.append(f"📊 事業所密度は標準的（{avg_density:.3f}）です。")
-        else:
-            comments.append(f"🏘️ 事業所密度が低め（{avg_density:.3f}）で、住宅地中心のエリアです。")
-        if avg_ratio > 0.3:
-            comments.append(f"💼 従業者比率が高く（{avg_ratio:.3f}）、雇用が活発です。")
-        elif avg_ratio > 0.2:
-            comments.append(f"👔 従業者比率は標準的（{avg_ratio:.3f}）です。")
-        else:
-            comments.append(f"🏠 従業者比率が低め（{avg_ratio:.3f}）です。")
-        if avg_size > 10:
-            comments.append(f"🏭 平均事業所規模が大きく（{avg_size:.1f}人/所）、中規模以上の企業が多いです。")
-        else:
-            comments.append(f"🏪 平均事業所規模は小さめ（{avg_size:.1f}人/所）で、小規模事業所中心です。")
+        # 閾値を超えた数がそのままコメントの添字になる（閾値ちょうどは下の区間）
+        comments = [
+            msgs[np.searchsorted(edges, means[column])].format(means[column])
+            for column, edges, msgs in INTERPRETATION_RULES
+        ]
         return " ".join(comments)
     except Exception as e:
         logger.error(f"解釈生成エラー: {e}")
@@ -476,22 +1116,23 @@ def generate_interpretation(metrics_df: pd.DataFrame) -> str:
 def generate_contextual_explanation(user_question: str, metrics_df: pd.DataFrame) -> str:
     """ユーザーの質問に応じた文脈説明を生成"""
     try:
-        question_lower = user_question.lower()
-        has_town = 'town_name' in metrics_df.columns and len(metrics_df['town_name'].unique()) > 1
-        has_year = 'year' in metrics_df.columns and len(metrics_df['year'].unique()) > 1
+        n_towns = metrics_df['town_name'].nunique() if 'town_name' in metrics_df.columns else 0
+        n_years = metrics_df['year'].nunique() if 'year' in metrics_df.columns else 0
+        has_town = n_towns > 1
+        has_year = n_years > 1
         explanations = []
-        if '密度' in question_lower or '世帯' in question_lower:
+        if '密度' in user_question or '世帯' in user_question:
             explanations.append("ご質問の内容に関連して、**事業所密度**（世帯数に対する事業所数の比率）を分析しました。")
-        if '比率' in question_lower or '割合' in question_lower or '人口' in question_lower:
+        if '比率' in user_question or '割合' in user_question or '人口' in user_question:
             explanations.append("**従業者比率**（人口に対する従業者数の割合）も計算し、地域の経済活動の活発さを評価しました。")
-        if '規模' in question_lower or '従業者' in question_lower:
+        if '規模' in user_question or '従業者' in user_question:
             explanations.append("**事業所規模**（1事業所あたりの従業者数）から、事業者の規模感を把握できます。")
         if has_town and has_year:
-            explanations.append(f"\n📍 {len(metrics_df['town_name'].unique())}の町名、{len(metrics_df['year'].unique())}年度のデータを比較しています。")
+            explanations.append(f"\n📍 {n_towns}の町名、{n_years}年度のデータを比較しています。")
         elif has_town:
-            explanations.append(f"\n📍 {len(metrics_df['town_name'].unique())}の町名を比較しています。")
+            explanations.append(f"\n📍 {n_towns}の町名を比較しています。")
         elif has_year:
-            explanations.append(f"\n📅 {len(metrics_df['year'].unique())}年度の推移を分析しています。")
+            explanations.append(f"\n📅 {n_years}年度の推移を分析しています。")
         if not explanations:
             return "ご質問に関連する経済指標を自動的に計算しました。以下の指標で地域の特徴を把握できます。"
         return " ".join(explanations)
@@ -504,15 +1145,25 @@ def get_top_bottom_insights(metrics_df: pd.DataFrame, metric_name: str, display_
     try:
         if metric_name not in metrics_df.columns or 'town_name' not in metrics_df.columns:
             return ""
-        df_sorted = metrics_df.sort_values(metric_name, ascending=False)
-        if 'year' in df_sorted.columns:
-            latest_year = df_sorted['year'].max()
-            df_sorted = df_sorted[df_sorted['year'] == latest_year]
-        top_towns = df_sorted.head(n)
-        bottom_towns = df_sorted.tail(n)
+        # 並べ替えの前に最新年度の行だけに絞り込む
+        df_latest = metrics_df
+        if 'year' in df_latest.columns:
+            years = df_latest['year'].to_numpy()
+            df_latest = df_latest[years == years.max()]
+        # 全体を並べ替えず、上位・下位n件だけを選択する（下位は値の大きい順に表示）
+        top_towns = df_latest.nlargest(n, metric_name)
+        bottom_towns = df_latest.nsmallest(n, metric_name).iloc[::-1]
+        top_str = ', '.join(
+            f'{town}（{value:.3f}）'
+            for town, value in zip(top_towns['town_name'].to_numpy(), top_towns[metric_name].to_numpy())
+        )
+        bottom_str = ', '.join(
+            f'{town}（{value:.3f}）'
+            for town, value in zip(bottom_towns['town_name'].to_numpy(), bottom_towns[metric_name].to_numpy())
+        )
         insights = f"\n\n**{display_name}の地域差:**\n"
-        insights += f"- 📈 **上位**: {', '.join([f'{row.town_name}（{row[metric_name]:.3f}）' for _, row in top_towns.iterrows()])}\n"
-        insights += f"- 📉 **下位**: {', '.join([f'{row.town_name}（{row[metric_name]:.3f}）' for _, row in bottom_towns.iterrows()])}"
+        insights += f"- 📈 **上位**: {top_str}\n"
+        insights += f"- 📉 **下位**: {bottom_str}"
         return insights
     except Exception as e:
         logger.error(f"洞察生成エラー: {e}")
@@ -1,11 +1,14 @@
 import streamlit as st
-import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 import pandas as pd
+import numpy as np
+from typing import Optional
+import re
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from utils import (
     generate_contextual_explanation, 
     generate_interpretation, 
-    generate_ai_summary,
     get_top_bottom_insights,
     load_geojson_data,
     get_yearly_business_summary,
@@ -14,10 +17,12 @@ from utils import (
     get_available_years,
     get_town_business_data,
     get_town_population_data,
-    get_town_crime_data
+    get_town_crime_data,
+    convert_df_to_csv,
+    METRIC_COLUMNS,
+    METRICS_DISPLAY_RENAME_MAP,
+    METRICS_COLUMN_CONFIG
 )
-import branca.colormap as cm
-from folium import Element
 
 METRIC_NAME_MAPPING = {
     "num_offices": "事業所数",
@@ -31,6 +36,21 @@ METRIC_NAME_MAPPING = {
     "offices_per_1000_pop": "人口1000人あたり事業所数",
 }
 
+# 結果表示用のカラム名の置換（カラム名の一部に含まれる場合も置換する）
+COLUMN_RENAME_MAP = {
+    'year': '年度',
+    'town_name': '町名',
+    'industry_name': '事業種別',
+    'major_crime': '犯罪大分類',
+    'minor_crime': '犯罪小分類',
+    'num_offices': '事業所数',
+    'num_employees': '従業者数',
+    'num_households': '世帯数',
+    'num_population': '人口',
+    'crime_count': '犯罪件数'
+}
+COLUMN_RENAME_PATTERN = re.compile('|'.join(map(re.escape, COLUMN_RENAME_MAP)))
+
 def render_header():
     """ タイトルと説明文を表示 """
     st.title("🏢 自然言語で八王子市の事業者データを分析")
@@ -79,11 +99,13 @@ def render_sample_questions():
 
 def render_main_form():
     """ メインの質問入力フォームを表示 """
-    st.text_input("🔍 分析したい内容を質問してください:", key="user_question")
-    st.button("🚀 分析を実行", type="primary", key="run_analysis_button")
+    # 入力中に再実行されないよう、質問入力と実行ボタンをフォームにまとめる
+    with st.form("query_form"):
+        st.text_input("🔍 分析したい内容を質問してください:", key="user_question")
+        st.form_submit_button("🚀 分析を実行", type="primary", key="run_analysis_button")
 
-def render_results(result_df, generated_sql, user_question, model_name):
-    """ SQLとクエリ結果のデータフレームを表示 """
+def render_results(result_df, generated_sql, ai_comment):
+    """ SQLとクエリ結果のデータフレーム、AIによる分析コメントを表示 """
     if generated_sql:
         with st.expander("📝 生成されたSQLクエリ", expanded=False):
             st.code(generated_sql, language="sql")
@@ -91,36 +113,16 @@ def render_results(result_df, generated_sql, user_question, model_name):
     if result_df is not None and not result_df.empty:
         st.success(f"✅ クエリ結果 ({len(result_df)}行)")
         
-        # 表示用にカラム名を日本語に置換
-        display_df = result_df.copy()
-        rename_map = {
-            'year': '年度',
-            'town_name': '町名',
-            'industry_name': '事業種別',
-            'major_crime': '犯罪大分類',
-            'minor_crime': '犯罪小分類',
-            'num_offices': '事業所数',
-            'num_employees': '従業者数',
-            'num_households': '世帯数',
-            'num_population': '人口',
-            'crime_count': '犯罪件数'
-        }
-        
-        new_columns = {}
-        for col in display_df.columns:
-            new_col = col
-            for en, jp in rename_map.items():
-                new_col = new_col.replace(en, jp)
-            new_columns[col] = new_col
-        
-        display_df = display_df.rename(columns=new_columns)
+        # 表示用にカラム名を日本語に置換（表示するだけなので、データはコピーせず元のDataFrameと共有する）
+        display_df = result_df.rename(
+            columns=lambda col: COLUMN_RENAME_PATTERN.sub(lambda m: COLUMN_RENAME_MAP[m.group(0)], col),
+            copy=False
+        )
         st.dataframe(display_df, use_container_width=True)
     elif result_df is not None:
         st.warning("⚠️ 結果が0件でした。質問を変えてみてください。")
 
     if result_df is not None and not result_df.empty:
-        with st.spinner(f"🤖 AI ({model_name}) が結果を分析中..."):
-            ai_comment = generate_ai_summary(result_df, user_question, model_name)
         if ai_comment:
             with st.expander("🤖 AIによる分析コメント", expanded=True):
                 st.markdown(ai_comment)
@@ -149,98 +151,129 @@ def render_metrics_and_insights(metrics_df, user_question, query_params):
     
     st.subheader("📊 経済指標の詳細分析")
 
+    # 各指標の平均はまとめて一度だけ計算する
+    means = metrics_df[METRIC_COLUMNS].mean()
+
     # メトリクス表示
     col1, col2, col3, col4 = st.columns(4)
-    col1.metric("平均事業所密度", f"{metrics_df['office_density'].mean():.4f}", help="事業所数 ÷ 世帯数")
-    col2.metric("平均従業者比率", f"{metrics_df['employee_ratio'].mean():.4f}", help="従業者数 ÷ 人口数")
-    col3.metric("平均事業所規模", f"{metrics_df['office_size'].mean():.1f}人", help="従業者数 ÷ 事業所数")
-    col4.metric("人口1000人あたり事業所数", f"{metrics_df['offices_per_1000_pop'].mean():.1f}", help="(事業所数 ÷ 人口) × 1000")
+    col1.metric("平均事業所密度", f"{means['office_density']:.4f}", help="事業所数 ÷ 世帯数")
+    col2.metric("平均従業者比率", f"{means['employee_ratio']:.4f}", help="従業者数 ÷ 人口数")
+    col3.metric("平均事業所規模", f"{means['office_size']:.1f}人", help="従業者数 ÷ 事業所数")
+    col4.metric("人口1000人あたり事業所数", f"{means['offices_per_1000_pop']:.1f}", help="(事業所数 ÷ 人口) × 1000")
 
     # 解釈と洞察
-    interpretation = generate_interpretation(metrics_df)
+    interpretation = generate_interpretation(means)
     insights = ""
-    if 'town_name' in metrics_df.columns and len(metrics_df['town_name'].unique()) > 1:
+    if 'town_name' in metrics_df.columns and metrics_df['town_name'].nunique() > 1:
         insights += get_top_bottom_insights(metrics_df, 'office_density', '事業所密度')
     
     st.success(f"💡 **データから読み取れること**\n\n{interpretation}{insights}")
 
     # 詳細データ
     with st.expander("📋 詳細な指標データを表示"):
-        display_cols = ['year', 'town_name', 'num_offices', 'num_employees', 'num_households', 'num_population',
-                      'office_density', 'employee_ratio', 'office_size', 'offices_per_1000_pop']
-        available_cols = [col for col in display_cols if col in metrics_df.columns]
-        col_rename = {'year': '年度', 'town_name': '町名', 'num_offices': '事業所数', 'num_employees': '従業者数',
-                      'num_households': '世帯数', 'num_population': '人口数', 'office_density': '事業所密度',
-                      'employee_ratio': '従業者比率', 'office_size': '事業所規模', 'offices_per_1000_pop': '人口千人あたり事業所数'}
-        display_df = metrics_df[available_cols].rename(columns=col_rename)
-        st.dataframe(display_df.round(4), use_container_width=True, hide_index=True)
-        csv = display_df.to_csv(index=False).encode('utf-8-sig')
+        available_cols = [col for col in METRICS_DISPLAY_RENAME_MAP if col in metrics_df.columns]
+        display_df = metrics_df[available_cols].rename(columns=METRICS_DISPLAY_RENAME_MAP, copy=False)
+        st.dataframe(display_df, column_config=METRICS_COLUMN_CONFIG, use_container_width=True, hide_index=True)
+        csv = convert_df_to_csv(display_df)
         st.download_button("📥 CSVでダウンロード", csv, "hachioji_metrics.csv", "text/csv")
 
+# 地図の表示高さ（ピクセル）
+MAP_HEIGHT = 700
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_folium_map_html(df: pd.DataFrame, metric_to_map: str) -> Optional[str]:
+    """ 町名と指標の値からFolium地図を組み立て、HTMLとしてキャッシュする """
+    # folium/branca は読み込みが重いため、地図を描くときに初めてインポートする
+    import folium
+    import branca.colormap as cm
+    from folium import Element
+
+    gdf = load_geojson_data()
+    if gdf is None:
+        return None
+
+    map_df = gdf.merge(df, on='town_name', how='inner')
+    if map_df.empty:
+        return None
+
+    m = folium.Map(
+        location=[35.655, 139.33], 
+        zoom_start=11,
+        tiles='https://cyberjapandata.gsi.go.jp/xyz/std/{z}/{x}/{y}.png',
+        attr='国土地理院'
+    )
+    
+    values = map_df[metric_to_map].values
+    vmin, vmax = values.min(), values.max()
+    colormap = cm.LinearColormap(
+        colors=['#d73027', '#fee08b', '#1a9850'],
+        index=[vmin, (vmin + vmax) / 2, vmax],
+        vmin=vmin,
+        vmax=vmax,
+        caption=f'{METRIC_NAME_MAPPING.get(metric_to_map, metric_to_map)} の値'
+    )
+    
+    # 地物ごとにcolormapを呼ばず、塗り色をまとめて計算しておく（branca の線形補間と同じ色になる）
+    stops = np.asarray(colormap.colors)
+    if vmin == vmax:
+        # 値がすべて同じ場合、branca は先頭（最小側）の色を返すが、np.interp は末尾の色になるため個別に扱う
+        channels = np.tile(stops[0], (len(values), 1))
+    else:
+        channels = np.column_stack([np.interp(values, colormap.index, stops[:, i]) for i in range(4)])
+    rgba = (channels * 255.9999).astype(np.uint8)
+    map_df['_fill'] = ['#%02x%02x%02x%02x' % tuple(color) for color in rgba]
+
+    folium.GeoJson(
+        map_df,
+        style_function=lambda feature: {
+            'fillColor': feature['properties']['_fill'],
+            'color': 'gray',
+            'weight': 1,
+            'fillOpacity': 0.7,
+        },
+        highlight_function=lambda feature: {
+            'fillColor': feature['properties']['_fill'],
+            'color': 'blue',
+            'weight': 3,
+            'fillOpacity': 0.95,
+        },
+        tooltip=folium.GeoJsonTooltip(
+            fields=['town_name', metric_to_map],
+            aliases=['町名:', f'{METRIC_NAME_MAPPING.get(metric_to_map, metric_to_map)}:'],
+            style=('background-color: white; color: black; '
+                'font-family: courier new; font-size: 12px; padding: 10px;')
+        )
+    ).add_to(m)
+    
+    colormap.add_to(m)
+
+    css_style = """
+    <style>
+    path.leaflet-interactive:focus {
+        outline: none !important;
+    }
+    </style>
+    """
+    m.get_root().html.add_child(Element(css_style))
+
+    return m.get_root().render()
+
 def render_folium_map(df: pd.DataFrame, metric_to_map: str):
     """ Folium地図を生成・表示する共通関数 """
     with st.spinner("🗺️ 地図データを生成中..."):
-        gdf = load_geojson_data()
-        if gdf is None:
+        if load_geojson_data() is None:
             st.error("❌ 地図データの読み込みに失敗しました。")
             return
 
-        map_df = gdf.merge(df, on='town_name', how='inner')
-        if map_df.empty:
+        # 地図に埋め込むのは町名と表示する指標だけにして、ブラウザへ送るGeoJSONを小さくする
+        # 同じデータ・指標の地図は再実行のたびに組み立て直さず、生成済みのHTMLを使う
+        html = build_folium_map_html(df[['town_name', metric_to_map]], metric_to_map)
+        if html is None:
             st.warning("⚠️ 地図データと結合できる町名が見つかりませんでした。")
             return
 
-        m = folium.Map(
-            location=[35.655, 139.33], 
-            zoom_start=11,
-            tiles='https://cyberjapandata.gsi.go.jp/xyz/std/{z}/{x}/{y}.png',
-            attr='国土地理院'
-        )
-        
-        values = map_df[metric_to_map].values
-        vmin, vmax = values.min(), values.max()
-        colormap = cm.LinearColormap(
-            colors=['#d73027', '#fee08b', '#1a9850'],
-            index=[vmin, (vmin + vmax) / 2, vmax],
-            vmin=vmin,
-            vmax=vmax,
-            caption=f'{METRIC_NAME_MAPPING.get(metric_to_map, metric_to_map)} の値'
-        )
-        
-        folium.GeoJson(
-            map_df,
-            style_function=lambda feature: {
-                'fillColor': colormap(feature['properties'][metric_to_map]),
-                'color': 'gray',
-                'weight': 1,
-                'fillOpacity': 0.7,
-            },
-            highlight_function=lambda feature: {
-                'fillColor': colormap(feature['properties'][metric_to_map]),
-                'color': 'blue',
-                'weight': 3,
-                'fillOpacity': 0.95,
-            },
-            tooltip=folium.GeoJsonTooltip(
-                fields=['town_name', metric_to_map],
-                aliases=['町名:', f'{METRIC_NAME_MAPPING.get(metric_to_map, metric_to_map)}:'],
-                style=('background-color: white; color: black; '
-                    'font-family: courier new; font-size: 12px; padding: 10px;')
-            )
-        ).add_to(m)
-        
-        colormap.add_to(m)
-
-        css_style = """
-        <style>
-        path.leaflet-interactive:focus {
-            outline: none !important;
-        }
-        </style>
-        """
-        m.get_root().html.add_child(Element(css_style))                    
-        
-        st_folium(m, use_container_width=True, returned_objects=[], key="hachioji_map_stats")
+        # 地図からの操作結果は使わないため、双方向のコンポーネントではなく静的なHTMLとして表示する
+        components.html(html, height=MAP_HEIGHT)
 
 def render_visualizations(result_df):
     """ グラフと地図を表示 """
@@ -250,37 +283,53 @@ def render_visualizations(result_df):
     st.markdown("--- ")
     st.subheader("📈 データ可視化")
 
+    # グラフと地図で共通して使うため、カラムの型判定は一度だけ行う
+    numeric_cols = result_df.select_dtypes(include=['number']).columns.tolist()
+    category_cols = result_df.select_dtypes(include=['object', 'string']).columns.tolist()
+
     try:
-        numeric_cols = [col for col in result_df.select_dtypes(include=['number']).columns if col != 'year']
-        category_cols = result_df.select_dtypes(include=['object']).columns.tolist()
-        if category_cols and numeric_cols:
-            chart_df = result_df.set_index(category_cols[0])[numeric_cols[0]]
-            st.bar_chart(chart_df)
+        chart_cols = [col for col in numeric_cols if col != 'year']
+        if category_cols and chart_cols:
+            # インデックスを作り直さず、x/y のカラムを指定して描画する
+            st.bar_chart(result_df, x=category_cols[0], y=chart_cols[0])
         else:
             st.write("グラフ化に適したデータ（カテゴリと数値の組み合わせ）がありませんでした。")
     except Exception as e:
         st.warning(f"グラフ描画スキップ: {e}")
 
-    numeric_cols = result_df.select_dtypes(include=['number']).columns.tolist()
-    if 'town_name' in result_df.columns and len(numeric_cols) > 0:
-        st.subheader("🗺️ 地図で結果を確認")
-        metric_to_map = st.selectbox(
-            "地図に表示する指標を選択してください:", 
-            options=numeric_cols, 
-            index=0,
-            format_func=lambda x: METRIC_NAME_MAPPING.get(x, x),
-            key="lang_query_map_metric"
-        )
-        render_folium_map(result_df, metric_to_map)
+    # 町が1つしかない結果（単一町の推移など）は色分けの意味がないため、地図を表示しない
+    if 'town_name' in result_df.columns and len(numeric_cols) > 0 and result_df['town_name'].nunique() > 1:
+        render_result_map(result_df, numeric_cols)
+
+# 指標を切り替えたときは、ページ全体ではなく地図部分だけを再実行する
+@st.fragment
+def render_result_map(result_df: pd.DataFrame, numeric_cols: list[str]):
+    """ 分析結果の指標を選択して地図に表示する """
+    st.subheader("🗺️ 地図で結果を確認")
+    metric_to_map = st.selectbox(
+        "地図に表示する指標を選択してください:", 
+        options=numeric_cols, 
+        index=0,
+        format_func=lambda x: METRIC_NAME_MAPPING.get(x, x),
+        key="lang_query_map_metric"
+    )
+    render_folium_map(result_df, metric_to_map)
 
 def render_basic_statistics_view():
     """ 基本統計データを表示する """
     st.subheader("八王子市 基本統計データ（年度別）")
     st.markdown("八王子市全体の年度別主要統計データの推移です。")
 
+    # 年度別の集計は互いに独立しているため、並行して取得する
+    with ThreadPoolExecutor(max_workers=4, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+        business_future = executor.submit(get_yearly_business_summary)
+        population_future = executor.submit(get_yearly_population_summary)
+        crime_future = executor.submit(get_yearly_crime_summary)
+        years_future = executor.submit(get_available_years)
+
     st.markdown("--- ")
     st.subheader("🏢 事業所数・従業員数の推移")
-    business_df = get_yearly_business_summary()
+    business_df = business_future.result()
     if business_df is not None and not business_df.empty:
         business_df_chart = business_df.set_index('year')
         st.line_chart(business_df_chart)
@@ -294,7 +343,7 @@ def render_basic_statistics_view():
 
     st.markdown("--- ")
     st.subheader("👨‍👩‍👧‍👦 世帯数・人口の推移")
-    population_df = get_yearly_population_summary()
+    population_df = population_future.result()
     if population_df is not None and not population_df.empty:
         population_df_chart = population_df.set_index('year')
         st.line_chart(population_df_chart)
@@ -308,7 +357,7 @@ def render_basic_statistics_view():
 
     st.markdown("--- ")
     st.subheader("🚓 犯罪件数の推移")
-    crime_df = get_yearly_crime_summary()
+    crime_df = crime_future.result()
     if crime_df is not None and not crime_df.empty:
         crime_df_chart = crime_df.set_index('year')
         st.line_chart(crime_df_chart)
@@ -323,11 +372,17 @@ def render_basic_statistics_view():
     st.markdown("--- ")
     st.subheader("🗺️ 町名別データの地図表示")
 
-    available_years = get_available_years()
+    available_years = years_future.result()
     if not available_years:
         st.warning("地図表示に利用できるデータがありませんでした。")
         return
 
+    render_town_map(available_years)
+
+# 年度・データ種類・指標を切り替えたときは、ページ全体ではなく地図部分だけを再実行する
+@st.fragment
+def render_town_map(available_years: list[int]):
+    """ 選択した年度・データ種類の町名別データを地図に表示する """
     col1, col2 = st.columns(2)
     with col1:
         selected_year = st.selectbox("表示する年度を選択", options=available_years, key="map_year")
@@ -363,12 +418,17 @@ def render_basic_statistics_view():
     else:
         st.info(f"{selected_year}年の{data_type}がありませんでした。")
     
+@st.cache_data(show_spinner=False)
+def load_logo_svg() -> str:
+    """ 運営会社ロゴのSVGを読み込み、キャッシュする """
+    with open("images/abt_logo.svg", "r") as f:
+        return f.read()
+
 def render_about_page():
     """「このサービスについて」ページを表示する"""
 
-    # SVGファイルを読み込み
-    with open("images/abt_logo.svg", "r") as f:
-        svg_content = f.read()
+    # タブは再実行のたびに描画されるため、SVGファイルは一度だけ読み込む
+    svg_content = load_logo_svg()
 
     st.subheader("🏢 運営会社")
     st.markdown(